@@ -1,8 +1,44 @@
+import asyncio
+import concurrent.futures
+import functools
+import queue
 import socket
 import logging
+import threading
 
 
-def gopher_request(host, port, selector, stats, timeout=5, max_size=1048576):
+def _record_error(stats, selector, error_msg):
+    """
+    Log an error and record it in the statistics.
+
+    :param stats: A dictionary to keep track of various statistics including errors.
+    :param selector: The selector the error occurred on.
+    :param error_msg: The message describing the error.
+    """
+    logging.info("%s", error_msg)
+    stats['errors'] += 1
+    stats['error_details'].append((selector, error_msg))  # Record the error message in detail
+
+
+async def _resolve_address(host, port, resolved_addresses):
+    """
+    Resolve a server to a socket address, reusing an earlier lookup when there is one.
+
+    :param host: The hostname of the server.
+    :param port: The port number of the server.
+    :param resolved_addresses: A dictionary of socket addresses already resolved, keyed by (host, port).
+
+    :return: The (address, port) tuple to connect to.
+    """
+    key = (host, port)
+    if key not in resolved_addresses:
+        loop = asyncio.get_running_loop()
+        infos = await loop.getaddrinfo(host, port, family=socket.AF_INET, type=socket.SOCK_STREAM)
+        resolved_addresses[key] = infos[0][4]
+    return resolved_addresses[key]
+
+
+async def gopher_request(host, port, selector, stats, timeout=5, max_size=1048576):
     """
     Send a request to a gopher server and receive a response.
 
@@ -15,37 +51,43 @@ def gopher_request(host, port, selector, stats, timeout=5, max_size=1048576):
 
     :return: The response data as bytes, or None if an error occurred.
     """
+    loop = asyncio.get_running_loop()
     with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-        s.settimeout(timeout)
+        s.setblocking(False)    # The event loop drives the socket, each step is bounded by 'timeout'
+        s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)  # Send the selector without delay
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 20)  # Let the server fill a larger window
         request = selector + "\r\n"
-        logging.info(f"Sending request to {host}:{port}: {request.strip()}")
+        logging.info("Sending request to %s:%d: %s", host, port, selector)
         try:
-            s.connect((host, port))
-            s.sendall(request.encode())
-            response = b""
+            # Each server is only looked up once per crawl
+            resolved_addresses = stats.setdefault('resolved_addresses', {})
+            address = await asyncio.wait_for(_resolve_address(host, port, resolved_addresses), timeout)
+            await asyncio.wait_for(loop.sock_connect(s, address), timeout)
+            await asyncio.wait_for(loop.sock_sendall(s, request.encode()), timeout)
+            # Receive straight into one preallocated buffer, so no object is created per chunk.
+            # The spare byte tells a response of exactly 'max_size' apart from an oversized one.
+            response = bytearray(max_size + 1)
+            view = memoryview(response)
+            received = 0
             while True:
-                data = s.recv(1024)
-                if not data:
-                    break
-                response += data
-                if len(response) > max_size:    # Prevent excessive data
-                    error_msg = f"Data exceeded {max_size} bytes, skipping file."
-                    logging.info(f"{error_msg}")
-                    stats['errors'] += 1
-                    stats['error_details'].append((selector, error_msg))  # Record the error message in detail
+                remaining = max_size + 1 - received     # Each read is capped by what is left of the buffer
+                if not remaining:   # Even the spare byte was filled, prevent excessive data
+                    _record_error(stats, selector, f"Data exceeded {max_size} bytes, skipping file.")
                     return None
-            return response
+                count = await asyncio.wait_for(
+                    loop.sock_recv_into(s, view[received:received + min(65536, remaining)]), timeout)
+                if not count:
+                    break
+                received += count
+            return bytes(view[:received])
         except ConnectionRefusedError:  # If the server refused to connect
-            error_msg = "Connection refused."
-            logging.info(f"{error_msg}")
-            stats['errors'] += 1
-            stats['error_details'].append((selector, error_msg))
+            _record_error(stats, selector, "Connection refused.")
+            return None
+        except asyncio.TimeoutError:  # If the transmission speed of information is too slow or unable to connect
+            _record_error(stats, selector, "Connection timed out.")
             return None
-        except socket.timeout:  # If the transmission speed of information is too slow or unable to connect
-            error_msg = "Connection timed out."
-            logging.info(f"{error_msg}")
-            stats['errors'] += 1
-            stats['error_details'].append((selector, error_msg))
+        except OSError as e:    # Any other network error, e.g. connection reset, unreachable host or unknown host
+            _record_error(stats, selector, f"Network error: {e}")
             return None
 
 
@@ -56,21 +98,19 @@ def parse_directory(response):
     :param response: The byte string response received from the server.
 
     :return: A list of tuples containing the type, display string, selector, host, and port.
+             Information ('i') items are left out.
     """
     items = []
-    try:
-        decoded_response = response.decode('utf-8')  # Attempt to decode response
-    except UnicodeDecodeError:
-        decoded_response = response.decode('iso-8859-1')  # Handling decoding errors
-
-    lines = decoded_response.splitlines()
-    for line in lines:
-        parts = line.split('\t')
+    # Work on the raw bytes and decode only the fields that are kept, instead of the whole response
+    for line in response.splitlines():
+        parts = line.split(b'\t')
         if len(parts) >= 4:  # Ensure that the format of the data is correct
-            item_type = parts[0][0]
-            display_string = parts[0][1:].strip()
-            selector = parts[1]
-            host = parts[2]
+            if parts[0][0:1] == b'i':  # Information items are not references, skip them before any decoding
+                continue
+            item_type = parts[0][0:1].decode('ascii', errors='replace')
+            display_string = parts[0][1:].decode('utf-8', errors='replace').strip()
+            selector = parts[1].decode('utf-8', errors='replace')
+            host = parts[2].decode('utf-8', errors='replace')
             try:
                 port = int(parts[3])
                 # In general, the port number will not be zero.
@@ -79,14 +119,17 @@ def parse_directory(response):
                     continue
                 items.append((item_type, display_string, selector, host, port))
             except ValueError:
-                logging.info(f"Error parsing port for line: {line}")
+                logging.info("Error parsing port for line: %s", line.decode('utf-8', errors='replace'))
     return items
 
 
+@functools.lru_cache(maxsize=None)
 def check_server_active(host, port):
     """
     Check if a server is active by attempting to connect to it.
 
+    The result is cached, so each external server is only probed once per process.
+
     :param host: The hostname of the server to check.
     :param port: The port number of the server to check.
 
@@ -98,125 +141,195 @@ def check_server_active(host, port):
             sock.connect((host, port))
             return True
     except socket.error as e:   # Unable to connect external server
-        logging.info(f"Failed to connect to {host}:{port} - {e}")
+        logging.info("Failed to connect to %s:%d - %s", host, port, e)
         return False
 
 
-# Used to record visited paths and checked external servers
-# Prevent duplicate visit of a path
-visited_paths = set()
-external_servers_checked = set()
-
-
-def crawl_gopher(host, port, selector="", stats=None, original_host=None):
+async def crawl_gopher(host, port, selector="", stats=None, concurrency=64):
     """
-    Recursively crawl a gopher server to retrieve directory and file information.
+    Crawl a gopher server to retrieve directory and file information.
+
+    Directories and files are put on a shared first-in first-out work queue and fetched
+    breadth-first by a pool of concurrent workers, so that many requests are in flight at
+    the same time. Any server other than the starting host and port is treated as external.
 
     :param host: The hostname of the gopher server.
     :param port: The port number of the gopher server.
     :param selector: The initial selector to start crawling from.
     :param stats: A dictionary to collect statistics and information during crawling.
-    :param original_host: The original host to compare for external server checks.
+    :param concurrency: The number of requests that may be in flight at the same time.
 
     :return: The stats dictionary updated with the information collected.
     """
 
     if stats is None:
         stats = {
-            'dirs': 0, 'files': 0, 'text_files': [], 'binary_files': [],
+            'dirs': 0, 'files': [],   # (kind, path, size) for every file, kind being 'text' or 'binary'
             'smallest_text': ('', float('inf')), 'largest_text': ('', 0),
             'smallest_binary': ('', float('inf')), 'largest_binary': ('', 0),
             'smallest_text_content': '',
             'external_servers': {}, 'errors': 0, 'error_details': [],
-            'all_files': [], 'all_directories': set()
+            'visited_paths': set(),  # (host, port, selector) of every directory queued, prevents duplicate visits
+            'external_references': set(),   # External (host, port) pairs, probed after the crawl
+            'resolved_addresses': {}    # Socket addresses by (host, port), so each server is looked up once
         }
 
-    global visited_paths
-    if original_host is None:
-        original_host = host
+    # Files are written to disk by a background thread, so the workers can go on with the next request
+    write_queue = queue.SimpleQueue()
+    writer = threading.Thread(target=_file_writer, args=(write_queue,), daemon=True)
+    writer.start()
+
+    work_queue = asyncio.Queue()
+    stats['visited_paths'].add((host, port, selector))
+    stats['dirs'] += 1
+    work_queue.put_nowait(('1', '', selector, host, port))
+    workers = [asyncio.create_task(_crawl_worker(work_queue, stats, write_queue, host, port))
+               for _ in range(concurrency)]
+    await work_queue.join()
+
+    for worker in workers:
+        worker.cancel()
+    await asyncio.gather(*workers, return_exceptions=True)
+
+    loop = asyncio.get_running_loop()
+    write_queue.put(None)   # Tell the writer to stop once every file queued so far has been written
+    await loop.run_in_executor(None, writer.join)
+
+    # Probe all external servers at once, so the wait is one timeout rather than one per server
+    external_servers = sorted(stats['external_references'])
+    with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = await asyncio.gather(*(loop.run_in_executor(executor, check_server_active, new_host, new_port)
+                                         for new_host, new_port in external_servers))
+    for (new_host, new_port), active in zip(external_servers, results):
+        stats['external_servers'][f"{new_host}:{new_port}"] = active
+
+    return stats
 
-    path = f"{host}:{port}{selector}"
-    if path in visited_paths:
-        return stats
-    visited_paths.add(path)
 
-    response = gopher_request(host, port, selector, stats)
+async def _crawl_worker(work_queue, stats, write_queue, original_host, port):
+    """
+    Take items from the work queue until cancelled, crawling directories and fetching files.
+    An unexpected error on one item is recorded in the statistics and the worker moves on, so the
+    work queue is always drained.
+
+    :param work_queue: The queue of items (type, display string, selector, host, port) to be fetched.
+    :param stats: A dictionary to collect statistics and information during crawling.
+    :param write_queue: The queue of files to be written to disk by the writer thread.
+    :param original_host: The original host to compare for external server checks.
+    :param port: The port number of the gopher server being crawled.
+    """
+    while True:
+        item = await work_queue.get()
+        try:
+            item_type, display_string, selector, new_host, new_port = item
+            if item_type == '1':
+                await _crawl_directory(new_host, new_port, selector, stats, work_queue, original_host, port)
+            else:   # '0' means text file and '9' means binary file
+                file_response = await gopher_request(new_host, new_port, selector, stats)
+                if file_response is not None:
+                    process_file(item, stats, file_response, write_queue, is_binary=(item_type == '9'))
+        except Exception as e:  # Keep the worker alive, a dead worker would leave items on the queue forever
+            _record_error(stats, item[2], f"Unexpected error: {e!r}")
+        finally:
+            work_queue.task_done()
+
+
+async def _crawl_directory(host, port, selector, stats, work_queue, original_host, original_port):
+    """
+    Fetch a single directory and put its directories and files on the work queue.
+    Directories are marked as visited when they are queued, so each one is fetched only once.
+
+    :param host: The hostname of the gopher server.
+    :param port: The port number of the gopher server.
+    :param selector: The selector of the directory.
+    :param stats: A dictionary to collect statistics and information during crawling.
+    :param work_queue: The work queue shared by the crawl workers.
+    :param original_host: The original host to compare for external server checks.
+    :param original_port: The original port to compare for external server checks.
+    """
+    response = await gopher_request(host, port, selector, stats)
     if response is None:
-        stats['error_details'].append((selector, "Failed to receive any response from server."))
-        stats['errors'] += 1
-        return stats
+        _record_error(stats, selector, "Failed to receive any response from server.")
+        return
 
     items = parse_directory(response)
     for item in items:
         item_type, display_string, selector, new_host, new_port = item
-        if new_host != original_host or new_port != port:
+        is_local = new_port == original_port and new_host == original_host   # Cheap int compare first
+        if not is_local:
             # This is an external server, and there is no need to crawl its content
-            server_key = f"{new_host}:{new_port}"
-            if server_key not in stats['external_servers']:
-                active = check_server_active(new_host, new_port)
-                stats['external_servers'][server_key] = active
+            stats['external_references'].add((new_host, new_port))
             continue
 
-        full_path = f"{new_host}:{new_port}{selector}"
-        if new_host == original_host and new_port == port:
-            if item_type == '1':    # The type is 'dictionary'
-                if full_path not in stats['all_directories']:
-                    stats['dirs'] += 1
-                    stats['all_directories'].add(full_path)
-                    crawl_gopher(new_host, new_port, selector, stats, original_host)
-            elif item_type in ['0', '9']:   # '0' means text file and '9' means binary file
-                file_response = gopher_request(new_host, new_port, selector, stats)
-                if file_response is not None:
-                    process_file(item, stats, file_response, is_binary=(item_type == '9'))
+        if item_type == '1':    # The type is 'dictionary'
+            # The event loop runs on a single thread, so check-and-add without an 'await' in between is safe
+            path = (new_host, new_port, selector)
+            if path not in stats['visited_paths']:
+                stats['visited_paths'].add(path)
+                stats['dirs'] += 1
+                work_queue.put_nowait(item)
+        elif item_type in ['0', '9']:   # '0' means text file and '9' means binary file
+            work_queue.put_nowait(item)
+        else:   # All other type are considered as unknown type and an error will be thrown out
+            _record_error(stats, selector, f"Unknown item type encountered: {item_type}")
 
-            elif item_type == 'i':  # Information item
-                continue
-            else:   # All other type are considered as unknown type and an error will be thrown out
-                error_msg = f"Unknown item type encountered: {item_type}"
-                stats['error_details'].append((selector, error_msg))
-                stats['errors'] += 1
 
-    return stats
+def _file_writer(write_queue):
+    """
+    Write files taken from the queue to disk until a None item is received.
+
+    :param write_queue: The queue of (file path, content) tuples to be written.
+    """
+    while True:
+        entry = write_queue.get()
+        if entry is None:
+            break
+        file_path, content = entry
+        try:
+            with open(file_path, 'wb', buffering=1 << 20) as f:
+                f.write(content)
+        except OSError as e:    # Keep writing the remaining files
+            logging.info("Failed to write %s - %s", file_path, e)
 
 
-def process_file(item, stats, response, is_binary=False):
+# Replace '/' with '_' to prevent mistaking file names for paths
+SAFE_NAME_TABLE = str.maketrans('/', '_')
+
+
+def process_file(item, stats, response, write_queue, is_binary=False):
     """
     Process a file received from the gopher server and update statistics.
 
     :param item: A tuple containing information about the file (type, display string, selector, host, port).
     :param stats: A dictionary where file statistics will be updated.
     :param response: The byte string response representing the file content.
+    :param write_queue: The queue the file is handed to for writing to disk.
     :param is_binary: A flag indicating if the file is binary or text.
     """
     item_type, display_string, selector, new_host, new_port = item
     original_file_path = f"{new_host}:{new_port}{selector}"
     safe_selector = selector[-100:]  # Handling long file names
-    safe_file_path = f"{new_host}:{new_port}{safe_selector}".replace('/', '_')
-    # Replace '/' with '_' to prevent mistaking file names for paths
+    safe_file_path = f"{new_host}:{new_port}{safe_selector}".translate(SAFE_NAME_TABLE)
     file_size = len(response)
 
+    # Text files are saved as the bytes received too, so no decoded copy is made just for writing
+    write_queue.put((safe_file_path, response))
+
     if is_binary:
-        with open(safe_file_path, 'wb') as f:
-            f.write(response)
-        stats['binary_files'].append((original_file_path, file_size))
-        if file_size < stats['smallest_binary'][1]:
+        smallest, largest = stats['smallest_binary'], stats['largest_binary']
+        if file_size < smallest[1]:
             stats['smallest_binary'] = (original_file_path, file_size)
-        if file_size > stats['largest_binary'][1]:
+        if file_size > largest[1]:
             stats['largest_binary'] = (original_file_path, file_size)
 
     else:
-        response_text = response.decode('utf-8')
-        with open(safe_file_path, 'w', encoding='utf-8') as f:
-            f.write(response_text)
-        stats['text_files'].append((original_file_path, file_size))
-        if file_size < stats['smallest_text'][1]:
+        smallest, largest = stats['smallest_text'], stats['largest_text']
+        if file_size < smallest[1]:
             stats['smallest_text'] = (original_file_path, file_size)
-            stats['smallest_text_content'] = response_text
-        if file_size > stats['largest_text'][1]:
+            stats['smallest_text_content'] = response.decode('utf-8', errors='replace')
+        if file_size > largest[1]:
             stats['largest_text'] = (original_file_path, file_size)
 
-    original_file_path = f"{new_host}:{new_port}{selector}".replace('_', '/')
-    stats['all_files'].append((original_file_path, file_size))
-    stats['files'] += 1
-    logging.info(
-        f"Processed {'binary' if is_binary else 'text'} file: {original_file_path} with size {file_size} bytes")
+    stats['files'].append(('binary' if is_binary else 'text', original_file_path, file_size))
+    logging.info("Processed %s file: %s with size %d bytes",
+                 'binary' if is_binary else 'text', original_file_path, file_size)
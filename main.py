@@ -1,3 +1,4 @@
+import asyncio
 import logging
 
 from gopher_crawler import crawl_gopher
@@ -26,19 +27,20 @@ def main():
                                   logging.StreamHandler()])
 
     # Start request process
-    stats = crawl_gopher(host, port)
+    stats = asyncio.run(crawl_gopher(host, port))
+
+    text_files = [(file_name, size) for kind, file_name, size in stats['files'] if kind == 'text']
+    binary_files = [(file_name, size) for kind, file_name, size in stats['files'] if kind == 'binary']
 
     # Save statistical data to a separate file
     with open('gopher_stats.txt', 'w', encoding='utf-8') as f:
         f.write(f"Total directories: {stats['dirs']}\n")
 
-        f.write(f"Text files: {len(stats['text_files'])}\n")
-        for file_name, size in stats['text_files']:
-            f.write(f"{file_name} with size {size} bytes\n")
+        f.write(f"Text files: {len(text_files)}\n")
+        f.writelines(f"{file_name} with size {size} bytes\n" for file_name, size in text_files)
 
-        f.write(f"Binary files: {len(stats['binary_files'])}\n")
-        for file_name, size in stats['binary_files']:
-            f.write(f"{file_name} with size {size} bytes\n")
+        f.write(f"Binary files: {len(binary_files)}\n")
+        f.writelines(f"{file_name} with size {size} bytes\n" for file_name, size in binary_files)
 
         f.write(f"Smallest text file: {stats['smallest_text']}\n")
         if 'smallest_text_content' in stats:
@@ -56,8 +58,7 @@ def main():
 
         if stats['error_details']:
             f.write("Error details:\n")
-            for detail in stats['error_details']:
-                f.write(str(detail) + "\n")
+            f.writelines(f"{detail}\n" for detail in stats['error_details'])
 
 
 if __name__ == "__main__":